@@ -1,12 +1,24 @@
 from enum import Enum
 from random import expovariate
 from abc import ABC, abstractmethod
+from array import array
+import gc
+import gzip
+import itertools
+import json
+import math
+import multiprocessing
+import pickle
+import random
+import sys
+import tracemalloc
 
 import matplotlib.pyplot as plt
 
 from typing import List
 from random import randint
 
+import numpy as np
 import pandas as pd
 
 import tqdm
@@ -76,6 +88,9 @@ class Person:
     
     LIFE_THREATENING_TEMPERATURE = 40.0
     LIFE_THREATENING_WATER_PCT = 0.5
+
+    # creation order, the order in which persons are visited at night
+    _serials = itertools.count()
     
     def __init__(self, home_position=(0, 0), age=30, weight=70, limits = {"min_i" : 0, "max_i": 100, "min_j":0, "max_j":100}):
         self.virus = None
@@ -87,6 +102,7 @@ class Person:
         self.home_position = home_position
         self.position = home_position
         self.state = Healthy(self)
+        self.serial = next(Person._serials)
 
         self.min_i = limits["min_i"]
         self.max_i = limits["max_i"]
@@ -100,6 +116,25 @@ class Person:
         self.hospitalized = False
         self.dead = False
         self.recovered = False
+        self.new_case = False
+
+        # set when the person joins a simulation
+        self.timer_wheel = None
+
+    @staticmethod
+    def _attribute_template(min_j, max_j, min_i, max_i):
+        # the attributes of __init__, bulk loading copies them and fills in
+        # the per-person values (antibody_types, weight, water, age,
+        # home_position, position, state, serial)
+        return {
+            "virus": None, "antibody_types": None, "temperature": 36.6,
+            "weight": None, "water": None, "age": None,
+            "home_position": None, "position": None, "state": None,
+            "serial": None,
+            "min_i": min_i, "max_i": max_i, "min_j": min_j, "max_j": max_j,
+            "infected": False, "hospitalized": False, "dead": False, "recovered": False,
+            "new_case": False, "timer_wheel": None,
+        }
 
     
     def day_actions(self):
@@ -114,9 +149,13 @@ class Person:
     def attach(self, obs):
         self.observer = obs
 
-    def update(self):
+    def get_flags(self):
         flags = [self.infected, self.hospitalized, self.dead, self.recovered, len(self.antibody_types) > 0]
-        self.observer.update([int(x) for x in flags])
+        return [int(x) for x in flags]
+
+    def update(self):
+        self.observer.update(self.get_flags(), self.new_case)
+        self.new_case = False
 
     def get_infected(self, virus):
         self.state.get_infected(virus)
@@ -217,6 +256,7 @@ class Hospital:
     def __init__(self, capacity, drug_repository):
         self.drug_repository = drug_repository
         self.capacity = capacity
+        self.beds = capacity
         
     def _treat_patient(self, patient):
         # 1. identify disease
@@ -259,14 +299,46 @@ class Hospital:
                 self._treat_patient(patient)
 
 
+class DailyMetrics:
+    '''Metrics derived from the daily counters, updated in O(1) per day.'''
+    COLUMNS = ["New cases", "Cumulative infections", "Incidence per 100k", "Doubling time", "Hospital occupancy"]
+
+    def __init__(self):
+        self.cumulative = 0
+
+    def add_day(self, counters, new_cases, population, beds):
+        previous = self.cumulative
+        self.cumulative += new_cases
+
+        incidence = new_cases / population * 100000 if population else 0.0
+        # days for the cumulative infections to double at today's growth
+        if previous and self.cumulative > previous:
+            doubling_time = math.log(2) / math.log(self.cumulative / previous)
+        else:
+            doubling_time = math.inf
+        occupancy = counters[1] / beds if beds else math.nan
+
+        return [new_cases, self.cumulative, incidence, doubling_time, occupancy]
+
+
 class DepartmentOfHealth:
+    COLUMNS = ["Infected", "Hospitalized", "Deaths", "Recoveries", "With antibodies"]
+    METRICS = DailyMetrics.COLUMNS
+
     def __init__(self, hospitals = 0):
         if hospitals != 0:
             self.hospitals = hospitals
 
             self.buffer = [0,0,0,0,0]
-
-            self.data = pd.DataFrame(columns = ["Infected", "Hospitalized", "Deaths", "Recoveries", "With antibodies"])
+            self.new_cases = 0
+            self.reports = 0
+            # dead persons no longer report, their last report is kept here
+            self.archived = [0,0,0,0,0]
+            self.n_archived = 0
+
+            self.metrics = DailyMetrics()
+            self.today = None
+            self.data = pd.DataFrame(columns = DepartmentOfHealth.COLUMNS + DepartmentOfHealth.METRICS)
             
 
     
@@ -282,13 +354,28 @@ class DepartmentOfHealth:
         pass
 
 
-    def update(self, data):
+    def update(self, data, new_case=False):
         self.buffer = [sum(x) for x in zip(self.buffer,data)]
+        self.new_cases += new_case
+        self.reports += 1
+
+    def archive(self, person):
+        self.archived = [sum(x) for x in zip(self.archived, person.get_flags())]
+        self.n_archived += 1
+
+    @property
+    def beds(self):
+        return sum(hospital.beds for hospital in self.hospitals)
 
     def end_day(self):
-        self.data.loc[len(self.data)] = self.buffer
+        counters = [sum(x) for x in zip(self.buffer, self.archived)]
+        row = counters + self.metrics.add_day(counters, self.new_cases, self.reports + self.n_archived, self.beds)
+        self.data.loc[len(self.data)] = row
+        self.today = dict(zip(self.data.columns, row))
         
         self.buffer = [0,0,0,0,0]
+        self.new_cases = 0
+        self.reports = 0
 
     
     __instance = None
@@ -298,11 +385,36 @@ class DepartmentOfHealth:
         return cls.__instance
 
 
+class TimerWheel:
+    '''Timed state transitions bucketed by the night they are due.
+
+    Every context has its own wheel and hands it to its persons. States
+    of such persons schedule themselves when they are entered, so every
+    night only the states whose transition is due are touched.
+    '''
+    def __init__(self):
+        self.now = 0
+        self.slots = {}
+
+    def schedule(self, due, state):
+        self.slots.setdefault(due, []).append(state)
+
+    def advance(self):
+        self.now += 1
+        return self.slots.pop(self.now, [])
+
+
 class GlobalContext:
     def __init__(self, canvas, persons, health_dept):
         self.canvas = canvas
         self.persons = persons
         self.health_dept = health_dept
+        self.timer_wheel = TimerWheel()
+        self.occupancy = None
+
+        # dead persons are moved out of `persons` every `compaction_interval` days
+        self.archive = []
+        self.compaction_interval = 1
         
     __instance = None
     def __new__(cls, *args):
@@ -310,26 +422,59 @@ class GlobalContext:
             cls.__instance = object.__new__(cls)
         return cls.__instance
 
-def simulate_day(context):
+def simulate_day(context, recorder=None):
     persons, health_dept, hospitals = context.persons, context.health_dept, context.health_dept.hospitals
+    occupancy = context.occupancy
+
+    if recorder is not None:
+        recorder.begin_day(persons)
 
     health_dept.make_policy()
     
     for hospital in hospitals:
         #print('Treating patients')
         hospital.treat_patients(persons)
+
+    if recorder is not None:
+        recorder.end_phase("treatment", persons)
     
     for person in persons:
         #print("Day actions")
         person.day_actions()
+
+    if recorder is not None:
+        recorder.end_phase("movement", persons)
+    if occupancy is not None:
+        occupancy.begin_day([person.position for person in persons])
     
     for person in persons:
         for other in persons:
             if person is not other and person.is_close_to(other):
-                person.interact(other)
+                if recorder is not None:
+                    recorder.contact(person, other)
+                if occupancy is not None:
+                    state = other.state
+                    person.interact(other)
+                    if other.state is not state:
+                        occupancy.infection(other.position)
+                else:
+                    person.interact(other)
+
+    if recorder is not None:
+        recorder.end_phase("contacts", persons)
                 
-    for person in persons:
-        person.night_actions()
+    # only the states with a transition due tonight are touched, a state that
+    # was left in the meantime has nothing to do. Viruses are shared between
+    # persons, so the night keeps the population order.
+    for state in sorted(context.timer_wheel.advance(), key=lambda state: state.person.serial):
+        if state.person.state is state:
+            state.on_timer()
+
+    if recorder is not None:
+        recorder.end_phase("night", persons)
+
+    if context.compaction_interval and (len(health_dept.data) + 1) % context.compaction_interval == 0:
+        compact_population(context)
 
     # sending information to HealthDepartment
     for person in persons:
@@ -337,17 +482,36 @@ def simulate_day(context):
     
     # department finishes workday and calculates all statistics
     health_dept.end_day()
+    if occupancy is not None:
+        occupancy.end_day()
+
+    if recorder is not None:
+        recorder.end_day()
 
 
 
 
-def create_persons(min_j, max_j, min_i, max_i, n_persons):
+def compact_population(context):
+    # the dead never change again: the department keeps their counts and
+    # the daily loops only see the living
+    persons, health_dept = context.persons, context.health_dept
+    alive = []
+    for person in persons:
+        if person.dead:
+            health_dept.archive(person)
+            context.archive.append(person)
+        else:
+            alive.append(person)
+    persons[:] = alive
+
+
+def create_persons(min_j, max_j, min_i, max_i, n_persons, default_fraction=0.75, n_cholera=40, n_sars=40):
     factory_params = (min_j,max_j,min_i,max_i)
     
     default_factory = DefaultPersonFactory(*factory_params)
     community_factory = CommunityPersonFactory(*factory_params, community_position=(50, 50))
 
-    n_default_persons = int(n_persons * 0.75)
+    n_default_persons = int(n_persons * default_fraction)
     n_community_persons = n_persons - n_default_persons
 
     persons = []
@@ -357,10 +521,10 @@ def create_persons(min_j, max_j, min_i, max_i, n_persons):
     for i in range(n_community_persons):
         persons.append(community_factory.get_person())
 
-    for person in persons[:40]:
+    for person in persons[:n_cholera]:
         person.get_infected(Cholera())
 
-    for person in persons[40:80]:
+    for person in persons[n_cholera:n_cholera + n_sars]:
         person.get_infected(SARSCoV2())
 
     return persons
@@ -370,26 +534,38 @@ def create_department_of_health(hospitals):
     return DepartmentOfHealth(hospitals)
 
 
-def create_hospitals(n_hospitals):
+def create_hospitals(n_hospitals, capacity=100, drug_repository=None):
+    drug_repository = drug_repository or CheapDrugRepository
     hospitals = [
-        Hospital(capacity=100, drug_repository=CheapDrugRepository())
+        Hospital(capacity=capacity, drug_repository=drug_repository())
         for i in range(n_hospitals)
     ]
     return hospitals
 
 
-def initialize():
+def initialize(n_persons=300, n_hospitals=4, canvas=(0, 100, 0, 100), memory_budget=None,
+               capacity=100, drug_repository=None, population_file=None, **population):
+    # our citizen, either generated or loaded from a population file
+    if population_file is not None:
+        if population:
+            raise ValueError("{} cannot be combined with a population file".format(", ".join(sorted(population))))
+        canvas, columns = read_population(population_file)
+        n_persons = len(columns["kind"])
+
     # our little country
-    min_i, max_i = 0, 100
-    min_j, max_j = 0, 100
+    min_j, max_j, min_i, max_i = canvas
+
+    # fail before building a population that does not fit
+    if memory_budget is not None:
+        check_memory_budget(memory_budget, n_persons, canvas=canvas)
     
-    # our citizen
-    n_persons = 300
-    persons = create_persons(min_j, max_j, min_i, max_i, n_persons)
+    if population_file is not None:
+        persons = _build_population(canvas, columns)
+    else:
+        persons = create_persons(min_j, max_j, min_i, max_i, n_persons, **population)
         
     # our healthcare system
-    n_hospitals = 4
-    hospitals = create_hospitals(n_hospitals)
+    hospitals = create_hospitals(n_hospitals, capacity, drug_repository)
     
     health_dept = create_department_of_health(hospitals)
     
@@ -404,9 +580,925 @@ def initialize():
         health_dept
     )
 
+    # persons join the timer wheel of the context with their pending transitions
+    for p in persons:
+        p.timer_wheel = context.timer_wheel
+        p.state.schedule()
+
     return context
 
 
+def _region_worker(conn, region_params, region_seed):
+    # every region lives in its own process, so the DepartmentOfHealth and
+    # GlobalContext singletons are per region
+    random.seed(region_seed)
+    context = initialize(**region_params)
+    persons, health_dept = context.persons, context.health_dept
+    min_j, max_j, min_i, max_i = context.canvas
+
+    while True:
+        command, arg = conn.recv()
+
+        if command == "day":
+            simulate_day(context)
+            conn.send((list(health_dept.data.iloc[-1]), len(persons) + len(context.archive), health_dept.beds))
+
+        elif command == "emigrate":
+            # hospitalized and dead persons stay where they are
+            candidates = [p for p in persons if not (p.hospitalized or p.dead)]
+            travellers = random.sample(candidates, int(round(arg * len(candidates))))
+            leaving = set(map(id, travellers))
+            persons[:] = [p for p in persons if id(p) not in leaving]
+            for p in travellers:
+                # the observer and the timer wheel are local, they do not travel
+                p.observer = None
+                p.timer_wheel = None
+            conn.send(travellers)
+            for p in travellers:
+                # the local copies are gone, their pending timers must not fire
+                p.state = None
+
+        elif command == "immigrate":
+            for p in arg:
+                p.min_j, p.max_j, p.min_i, p.max_i = min_j, max_j, min_i, max_i
+                p.home_position = (randint(min_j, max_j), randint(min_i, max_i))
+                p.position = p.home_position
+                p.attach(health_dept)
+                p.timer_wheel = context.timer_wheel
+                p.state.schedule()
+            persons.extend(arg)
+            conn.send(len(persons) + len(context.archive))
+
+        elif command == "stop":
+            conn.close()
+            break
+
+
+class Metapopulation:
+    '''Several regions simulated in parallel processes with daily travel between them.
+
+    `regions` is a list of keyword arguments for `initialize`, one per region.
+    Every day a `travel_fraction` of the mobile persons of each region moves to
+    a randomly chosen other region.
+    '''
+    def __init__(self, regions, travel_fraction=0.01, seed=None):
+        self.travel_fraction = travel_fraction
+        self.random = random.Random(seed)
+        self.rows = [[] for _ in regions]
+        self.total_rows = []
+        self.total_metrics = DailyMetrics()
+        self.population = [params.get("n_persons", 300) for params in regions]
+
+        self.connections = []
+        self.workers = []
+        for r, params in enumerate(regions):
+            region_seed = None if seed is None else "{}-{}".format(seed, r)
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_region_worker, args=(child_conn, params, region_seed), daemon=True)
+            worker.start()
+            self.connections.append(parent_conn)
+            self.workers.append(worker)
+
+    def simulate_day(self):
+        # regions simulate their day concurrently
+        for conn in self.connections:
+            conn.send(("day", None))
+        counters, new_cases, population, beds = [0] * len(DepartmentOfHealth.COLUMNS), 0, 0, 0
+        for rows, conn in zip(self.rows, self.connections):
+            row, region_population, region_beds = conn.recv()
+            rows.append(row)
+
+            # ratios do not add up, the country metrics come from its counters
+            counters = [sum(x) for x in zip(counters, row)]
+            new_cases += row[len(DepartmentOfHealth.COLUMNS)]
+            population += region_population
+            beds += region_beds
+        self.total_rows.append(counters + self.total_metrics.add_day(counters, new_cases, population, beds))
+
+        if len(self.connections) > 1 and self.travel_fraction > 0:
+            self.travel()
+
+    def travel(self):
+        for conn in self.connections:
+            conn.send(("emigrate", self.travel_fraction))
+        departures = [conn.recv() for conn in self.connections]
+
+        arrivals = [[] for _ in self.connections]
+        n_regions = len(self.connections)
+        for origin, travellers in enumerate(departures):
+            for p in travellers:
+                destination = self.random.randrange(n_regions - 1)
+                if destination >= origin:
+                    destination += 1
+                arrivals[destination].append(p)
+
+        for conn, persons in zip(self.connections, arrivals):
+            conn.send(("immigrate", persons))
+        self.population = [conn.recv() for conn in self.connections]
+
+    def run(self, n_days):
+        for day in range(n_days):
+            self.simulate_day()
+        return self.data
+
+    @property
+    def region_data(self):
+        return [pd.DataFrame(rows, columns=DepartmentOfHealth.COLUMNS + DepartmentOfHealth.METRICS) for rows in self.rows]
+
+    @property
+    def data(self):
+        return pd.DataFrame(self.total_rows, columns=DepartmentOfHealth.COLUMNS + DepartmentOfHealth.METRICS)
+
+    def close(self):
+        for conn, worker in zip(self.connections, self.workers):
+            # a region that already died cannot be told to stop
+            if worker.is_alive():
+                try:
+                    conn.send(("stop", None))
+                except OSError:
+                    pass
+        for conn, worker in zip(self.connections, self.workers):
+            worker.join()
+            conn.close()
+        self.connections, self.workers = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CellOccupancy:
+    '''Daily occupancy and infection counts per grid cell.
+
+    Cells are `coarsen` x `coarsen` blocks of the canvas. Set it as
+    `context.occupancy` and `simulate_day` fills one row per day.
+    '''
+    def __init__(self, canvas, coarsen=1):
+        self.min_j, max_j, self.min_i, max_i = canvas
+        self.coarsen = coarsen
+        self.shape = ((max_j - self.min_j) // coarsen + 1, (max_i - self.min_i) // coarsen + 1)
+        self.n_cells = self.shape[0] * self.shape[1]
+        self.occupancy_rows = []
+        self.infection_rows = []
+
+    def _cells(self, positions):
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        j = np.clip((positions[:, 0] - self.min_j) // self.coarsen, 0, self.shape[0] - 1)
+        i = np.clip((positions[:, 1] - self.min_i) // self.coarsen, 0, self.shape[1] - 1)
+        return j * self.shape[1] + i
+
+    def begin_day(self, positions):
+        self.occupancy_rows.append(np.bincount(self._cells(positions), minlength=self.n_cells).astype(np.int32))
+        self.infections = []
+
+    def infection(self, position):
+        self.infections.append(position)
+
+    def end_day(self):
+        self.infection_rows.append(np.bincount(self._cells(self.infections), minlength=self.n_cells).astype(np.int32))
+
+    @property
+    def occupancy(self):
+        return np.array(self.occupancy_rows, dtype=np.int32).reshape(-1, self.n_cells)
+
+    @property
+    def infections_per_cell(self):
+        return np.array(self.infection_rows, dtype=np.int32).reshape(-1, self.n_cells)
+
+    def grid(self, day=None, infections=False):
+        table = self.infections_per_cell if infections else self.occupancy
+        counts = table.sum(axis=0) if day is None else table[day]
+        return counts.reshape(self.shape)
+
+    def hotspots(self, n=10, infections=True):
+        counts = self.grid(infections=infections).ravel()
+        cells = np.argsort(counts, kind="stable")[::-1][:n]
+        return pd.DataFrame({
+            "j": self.min_j + (cells // self.shape[1]) * self.coarsen,
+            "i": self.min_i + (cells % self.shape[1]) * self.coarsen,
+            "Count": counts[cells],
+        })
+
+
+def switch_drug_repository(drug_repository):
+    def intervention(context):
+        for hospital in context.health_dept.hospitals:
+            hospital.drug_repository = drug_repository()
+    return intervention
+
+
+def add_hospitals(n_hospitals, capacity=100, drug_repository=None):
+    def intervention(context):
+        context.health_dept.hospitals.extend(create_hospitals(n_hospitals, capacity, drug_repository))
+    return intervention
+
+
+def _run_branch(conn, context, intervention, n_days):
+    try:
+        if intervention is not None:
+            intervention(context)
+        for day in range(n_days):
+            simulate_day(context)
+        conn.send(context.health_dept.data)
+    except Exception as e:
+        conn.send(e)
+    conn.close()
+
+
+def branch_scenarios(context, interventions, n_days):
+    '''Forks the running simulation once per intervention and runs every branch for n_days.
+
+    `interventions` maps scenario names to callables applied to the forked
+    context (None leaves it as is). Branches share the population pages with
+    this process until they write to them and continue from the same random
+    state. Returns the tables of all scenarios indexed by (Scenario, Day).
+    '''
+    fork = multiprocessing.get_context("fork")
+
+    # objects that exist now are left alone by the collectors of the branches,
+    # so their pages stay shared
+    gc.collect()
+    gc.freeze()
+    branches = []
+    try:
+        for name, intervention in interventions.items():
+            parent_conn, child_conn = fork.Pipe(duplex=False)
+            process = fork.Process(target=_run_branch, args=(child_conn, context, intervention, n_days), daemon=True)
+            process.start()
+            child_conn.close()
+            branches.append((name, parent_conn, process))
+    finally:
+        gc.unfreeze()
+
+    results = {}
+    try:
+        for name, conn, process in branches:
+            try:
+                result = conn.recv()
+            except EOFError:
+                # the branch died without reporting, e.g. killed when out of memory
+                raise RuntimeError("scenario {} failed".format(name))
+            process.join()
+            if isinstance(result, Exception):
+                raise RuntimeError("scenario {} failed".format(name)) from result
+            results[name] = result
+    finally:
+        for name, conn, process in branches:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            conn.close()
+
+    return pd.concat(results, names=["Scenario", "Day"])
+
+
+def _sizeof(obj):
+    # shallow size of an object together with its own attribute containers,
+    # references to other agents' parts are accounted separately
+    size = sys.getsizeof(obj)
+    attributes = getattr(obj, "__dict__", None)
+    if attributes is not None:
+        size += sys.getsizeof(attributes)
+        for value in attributes.values():
+            if isinstance(value, (tuple, set, list, dict, float, str)):
+                size += sys.getsizeof(value)
+    return size
+
+
+class MemoryReport:
+    '''Bytes used by every subsystem of a running simulation.
+
+    Agent subsystems (persons, their states and viruses) are extrapolated from a
+    sample of persons, `bytes_per_day` is the growth of the statistics table.
+    '''
+    AGENT_SUBSYSTEMS = ("Person", "State", "Infectable")
+
+    def __init__(self, n_agents, sizes, groups, bytes_per_day, traced=None):
+        self.n_agents = n_agents
+        self.sizes = sizes
+        self.groups = groups
+        self.bytes_per_day = bytes_per_day
+        self.traced = traced
+
+    @property
+    def total_bytes(self):
+        return sum(self.sizes.values())
+
+    @property
+    def agent_bytes(self):
+        return sum(size for name, size in self.sizes.items() if self.groups[name] in MemoryReport.AGENT_SUBSYSTEMS)
+
+    @property
+    def bytes_per_agent(self):
+        return self.agent_bytes / self.n_agents if self.n_agents else 0.0
+
+    def projected_bytes(self, n_agents, n_days=0):
+        fixed = self.total_bytes - self.agent_bytes
+        return int(self.bytes_per_agent * n_agents + fixed + self.bytes_per_day * n_days)
+
+    def check_budget(self, budget, n_agents=None, n_days=0):
+        n_agents = self.n_agents if n_agents is None else n_agents
+        projected = self.projected_bytes(n_agents, n_days)
+        if projected > budget:
+            raise MemoryError("{} persons for {} days need about {} bytes, the budget is {} bytes".format(
+                n_agents, n_days, projected, budget))
+        return projected
+
+    def as_frame(self):
+        return pd.DataFrame(
+            [(self.groups[name], name, size) for name, size in sorted(self.sizes.items())],
+            columns=["Subsystem", "Type", "Bytes"]
+        )
+
+    def __str__(self):
+        lines = [str(self.as_frame())]
+        lines.append("bytes per agent: {:.1f}".format(self.bytes_per_agent))
+        lines.append("bytes per day of statistics: {:.1f}".format(self.bytes_per_day))
+        if self.traced is not None:
+            lines.append("traced by tracemalloc: {} bytes (peak {} bytes)".format(*self.traced))
+        return "\n".join(lines)
+
+
+def memory_report(context, sample_size=1000):
+    persons, health_dept = context.persons + context.archive, context.health_dept
+    sizes, groups = {}, {}
+
+    def account(group, obj, scale):
+        name = type(obj).__name__
+        groups[name] = group
+        sizes[name] = sizes.get(name, 0) + _sizeof(obj) * scale
+
+    # every step-th person is measured and stands for step persons
+    step = max(1, len(persons) // sample_size)
+    sample = persons[::step]
+    scale = len(persons) / len(sample) if sample else 0
+    for person in sample:
+        account("Person", person, scale)
+        account("State", person.state, scale)
+        if person.virus is not None:
+            account("Infectable", person.virus, scale)
+
+    # drugs only live during the treatment, two per hospitalized patient a day
+    n_patients = sum(1 for person in sample if person.hospitalized) * scale
+    for hospital in health_dept.hospitals:
+        repository = hospital.drug_repository
+        for drug in (repository.get_antifever(1.0), repository.get_sars_antivirus(1.0)):
+            account("Drug", drug, n_patients / len(health_dept.hospitals))
+
+    data_bytes = int(health_dept.data.memory_usage(deep=True).sum())
+    sizes["DepartmentOfHealth.data"] = data_bytes
+    groups["DepartmentOfHealth.data"] = "DepartmentOfHealth"
+    bytes_per_day = data_bytes / len(health_dept.data) if len(health_dept.data) else 0.0
+
+    sizes = {name: int(size) for name, size in sizes.items()}
+    traced = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else None
+    return MemoryReport(len(persons), sizes, groups, bytes_per_day, traced)
+
+
+def estimate_bytes_per_agent(sample_size=1000, canvas=(0, 100, 0, 100)):
+    # builds a throwaway population under tracemalloc, the random stream of
+    # the simulation is left untouched
+    random_state = random.getstate()
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+
+    persons = create_persons(*canvas, sample_size)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+
+    del persons
+    if not was_tracing:
+        tracemalloc.stop()
+    random.setstate(random_state)
+    return allocated / sample_size
+
+
+def check_memory_budget(budget, n_persons, n_days=0, bytes_per_day=64, canvas=(0, 100, 0, 100)):
+    projected = int(estimate_bytes_per_agent(canvas=canvas) * n_persons + bytes_per_day * n_days)
+    if projected > budget:
+        raise MemoryError("{} persons for {} days need about {} bytes, the budget is {} bytes".format(
+            n_persons, n_days, projected, budget))
+    return projected
+
+
+class Trace:
+    '''Events of a seeded run, day by day.
+
+    Every day holds the positions after the movement phase as a flat
+    array of (person id, j, i) triples and the list of events: contacts,
+    infections, state transitions, admissions, drug effects and discharges.
+    Person ids are indices in the initial population.
+    '''
+    def __init__(self, seed, params):
+        self.seed = seed
+        self.params = params
+        self.days = []
+
+    def save(self, path):
+        with gzip.open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with gzip.open(path, "rb") as f:
+            return pickle.load(f)
+
+
+class Divergence:
+    def __init__(self, day, what, expected, actual):
+        self.day = day
+        self.what = what
+        self.expected = expected
+        self.actual = actual
+
+    def __repr__(self):
+        return "Divergence(day={}, {}: expected {}, got {})".format(self.day, self.what, self.expected, self.actual)
+
+
+class TraceRecorder:
+    '''Collects the events of `simulate_day` into `trace.days`.'''
+    def __init__(self, trace):
+        self.trace = trace
+        self.ids = {}
+
+    def _id(self, person):
+        uid = self.ids.get(id(person))
+        if uid is None:
+            uid = self.ids[id(person)] = len(self.ids)
+        return uid
+
+    def _snapshot(self, persons):
+        return [(p.state.__class__.__name__, p.hospitalized) for p in persons]
+
+    def begin_day(self, persons):
+        self.events = []
+        self.positions = None
+        self.patients = [p for p in persons if p.hospitalized]
+        self.before = self._snapshot(persons)
+
+    def end_phase(self, phase, persons):
+        events = self.events
+        after = self._snapshot(persons)
+
+        if phase == "treatment":
+            for p in self.patients:
+                strength = p.virus.strength if p.virus is not None else None
+                events.append(("drug", self._id(p), round(p.temperature, 9), round(p.water, 9),
+                               strength if strength is None else round(strength, 9)))
+
+        elif phase == "movement":
+            positions = array("i")
+            for p in persons:
+                positions.extend((self._id(p),) + tuple(p.position))
+            self.positions = positions
+
+        for p, (old_state, was_hospitalized), (new_state, hospitalized) in zip(persons, self.before, after):
+            if old_state != new_state:
+                if phase == "contacts" and new_state == "AsymptomaticSick":
+                    events.append(("infect", self._id(p), p.virus.get_type().name))
+                events.append(("state", self._id(p), old_state, new_state))
+            if hospitalized and not was_hospitalized:
+                events.append(("admit", self._id(p)))
+            elif was_hospitalized and not hospitalized:
+                events.append(("discharge", self._id(p)))
+
+        self.before = after
+
+    def contact(self, person, other):
+        self.events.append(("contact", self._id(person), self._id(other)))
+
+    def end_day(self):
+        self.trace.days.append((self.positions, self.events))
+
+
+def _run_traced(trace, n_days, day_function):
+    random.seed(trace.seed)
+    context = initialize(**trace.params)
+    recorder = TraceRecorder(trace)
+    # ids follow the initial population order
+    for person in context.persons:
+        recorder._id(person)
+
+    for day in range(n_days):
+        day_function(context, recorder)
+        yield day
+
+
+def record_trace(n_days, seed=0, day_function=simulate_day, **params):
+    trace = Trace(seed, params)
+    for _ in _run_traced(trace, n_days, day_function):
+        pass
+    return trace
+
+
+def _compare_day(day, expected, actual):
+    (expected_positions, expected_events), (actual_positions, actual_events) = expected, actual
+
+    if expected_positions != actual_positions:
+        for k in range(0, max(len(expected_positions), len(actual_positions)), 3):
+            if expected_positions[k:k + 3] != actual_positions[k:k + 3]:
+                return Divergence(day, "position", tuple(expected_positions[k:k + 3]), tuple(actual_positions[k:k + 3]))
+
+    for k in range(max(len(expected_events), len(actual_events))):
+        expected_event = expected_events[k] if k < len(expected_events) else None
+        actual_event = actual_events[k] if k < len(actual_events) else None
+        if expected_event != actual_event:
+            return Divergence(day, "event {}".format(k), expected_event, actual_event)
+
+    return None
+
+
+def replay_trace(trace, day_function=simulate_day):
+    '''Runs `day_function` from the seed of `trace`, returns the first Divergence or None.'''
+    replayed = Trace(trace.seed, trace.params)
+    for day in _run_traced(replayed, len(trace.days), day_function):
+        divergence = _compare_day(day, trace.days[day], replayed.days[day])
+        if divergence is not None:
+            return divergence
+    return None
+
+
+def _sweep_job(job):
+    params, job_seed, n_days, metric = job
+    random.seed(job_seed)
+    context = initialize(**params)
+    for day in range(n_days):
+        simulate_day(context)
+    return context.health_dept.data[metric].iloc[-1]
+
+
+def sweep(configurations, n_days=100, replicates=3, seed=0, metric="Deaths", eta=3, min_days=None, processes=None):
+    '''Successive halving over `configurations`, a list of `initialize` keyword arguments.
+
+    All configurations are run for `min_days` days, the best 1/eta of them by
+    the mean of `metric` (lower is better) and those tied with them go on for
+    eta times longer, and so on until `n_days`. Replicate r of every configuration uses the seed
+    `seed + r`, so configurations are compared on common random numbers.
+    Returns one row per configuration, ranked.
+    '''
+    if eta < 2:
+        raise ValueError("eta must be at least 2, got {}".format(eta))
+    if min_days is None:
+        min_days = max(1, n_days // eta ** 2)
+    if min_days < 1:
+        raise ValueError("min_days must be at least 1, got {}".format(min_days))
+
+    horizons = [n_days]
+    while horizons[0] // eta >= min_days:
+        horizons.insert(0, horizons[0] // eta)
+
+    results = {}
+    alive = list(range(len(configurations)))
+    with multiprocessing.Pool(processes) as pool:
+        for rung, horizon in enumerate(horizons):
+            jobs = [(configurations[c], seed + r, horizon, metric) for c in alive for r in range(replicates)]
+            values = pool.map(_sweep_job, jobs)
+
+            for k, c in enumerate(alive):
+                outcome = pd.Series(values[k * replicates:(k + 1) * replicates], dtype=float)
+                results[c] = (rung, horizon, outcome.mean(), outcome.std())
+
+            if horizon < n_days:
+                # configurations tied with the last survivor are not clearly worse
+                alive.sort(key=lambda c: results[c][2])
+                cutoff = results[alive[max(1, -(-len(alive) // eta)) - 1]][2]
+                alive = [c for c in alive if results[c][2] <= cutoff]
+
+    rows = []
+    for c, (rung, horizon, mean, std) in results.items():
+        rows.append(dict(configurations[c], Configuration=c, Rung=rung, Days=horizon, Mean=mean, Std=std))
+    summary = pd.DataFrame(rows).sort_values(["Days", "Mean"], ascending=[False, True])
+    return summary.reset_index(drop=True)
+
+
+POPULATION_MAGIC = b"VSMSPOP1"
+POPULATION_COLUMNS = [
+    ("kind", "u1"),
+    ("home_j", "i4"), ("home_i", "i4"),
+    ("community_j", "i4"), ("community_i", "i4"),
+    ("age", "i2"), ("weight", "i2"),
+    ("virus", "u1"), ("strength", "f8"), ("contag", "f8"),
+    ("antibodies", "u1"),
+]
+PERSON_KINDS = [DefaultPerson, CommunityPerson]
+VIRUS_KINDS = {SeasonalFluVirus: InfectableType.SeasonalFlu, SARSCoV2: InfectableType.SARSCoV2, Cholera: InfectableType.Cholera}
+VIRUS_CLASSES = {infectable_type.value: cls for cls, infectable_type in VIRUS_KINDS.items()}
+
+
+def save_population(persons, path, canvas=(0, 100, 0, 100)):
+    '''Writes persons column by column: a magic, a JSON header and the raw columns.'''
+    columns = {name: np.zeros(len(persons), dtype=dtype) for name, dtype in POPULATION_COLUMNS}
+    for k, p in enumerate(persons):
+        columns["kind"][k] = PERSON_KINDS.index(type(p))
+        columns["home_j"][k], columns["home_i"][k] = p.home_position
+        columns["community_j"][k], columns["community_i"][k] = getattr(p, "community_position", (0, 0))
+        columns["age"][k], columns["weight"][k] = p.age, p.weight
+        if p.virus is not None:
+            columns["virus"][k] = VIRUS_KINDS[type(p.virus)].value
+            columns["strength"][k], columns["contag"][k] = p.virus.strength, p.virus.contag
+        columns["antibodies"][k] = sum(1 << t.value for t in p.antibody_types)
+
+    # columns start at 64 byte boundaries so they can be mapped in place
+    layout, offset = [], 0
+    for name, dtype in POPULATION_COLUMNS:
+        layout.append((name, dtype, offset))
+        offset += -(-columns[name].nbytes // 64) * 64
+    header = json.dumps({"n": len(persons), "canvas": list(canvas), "columns": layout}).encode()
+    data_start = -(-(len(POPULATION_MAGIC) + 8 + len(header)) // 64) * 64
+
+    with open(path, "wb") as f:
+        f.write(POPULATION_MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for name, dtype, column_offset in layout:
+            f.seek(data_start + column_offset)
+            f.write(columns[name].tobytes())
+        f.truncate(data_start + offset)
+
+
+def read_population(path):
+    '''Maps the columns of a population file without copying, returns (canvas, columns).'''
+    with open(path, "rb") as f:
+        if f.read(len(POPULATION_MAGIC)) != POPULATION_MAGIC:
+            raise ValueError("{} is not a population file".format(path))
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+
+    data_start = -(-(len(POPULATION_MAGIC) + 8 + header_size) // 64) * 64
+    columns = {}
+    for name, dtype, column_offset in header["columns"]:
+        if header["n"] == 0:
+            columns[name] = np.zeros(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(path, dtype=dtype, mode="r", offset=data_start + column_offset, shape=(header["n"],))
+    return tuple(header["canvas"]), columns
+
+
+def _build_population(canvas, columns):
+    n_persons = len(columns["kind"])
+
+    # whole columns are converted at once
+    kinds = [CommunityPerson if kind else DefaultPerson for kind in columns["kind"].tolist()]
+    homes = list(zip(columns["home_j"].tolist(), columns["home_i"].tolist()))
+    ages = columns["age"].tolist()
+    weights = columns["weight"].tolist()
+    waters = (0.6 * columns["weight"].astype(np.float64)).tolist()
+    first_serial = next(Person._serials)
+    Person._serials = itertools.count(first_serial + n_persons)
+
+    template = Person._attribute_template(*canvas)
+    copy_template, new = template.copy, object.__new__
+
+    # nothing to collect while building, the collector would rescan every
+    # new person many times over
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        persons = []
+        append = persons.append
+        for cls, home, age, weight, water, serial in zip(kinds, homes, ages, weights, waters,
+                                                         range(first_serial, first_serial + n_persons)):
+            person = new(cls)
+            state = new(Healthy)
+            state.person = person
+            attributes = copy_template()
+            attributes["antibody_types"] = set()
+            attributes["weight"] = weight
+            attributes["water"] = water
+            attributes["age"] = age
+            attributes["home_position"] = attributes["position"] = home
+            attributes["state"] = state
+            attributes["serial"] = serial
+            person.__dict__ = attributes
+            append(person)
+
+        # the remaining columns only matter for a few rows
+        for k in np.flatnonzero(columns["kind"]).tolist():
+            persons[k].community_position = (int(columns["community_j"][k]), int(columns["community_i"][k]))
+        for k in np.flatnonzero(columns["antibodies"]).tolist():
+            bits = int(columns["antibodies"][k])
+            persons[k].antibody_types.update(t for t in InfectableType if bits & (1 << t.value))
+        for k in np.flatnonzero(columns["virus"]).tolist():
+            virus = VIRUS_CLASSES[int(columns["virus"][k])](strength=float(columns["strength"][k]),
+                                                            contag=float(columns["contag"][k]))
+            persons[k].get_infected(virus)
+    finally:
+        if collecting:
+            gc.enable()
+    return persons
+
+
+def load_population(path):
+    return _build_population(*read_population(path))
+
+
+def _compartment(person):
+    # Healthy persons are outside of the disease compartments
+    state = person.state
+    if isinstance(state, Dead):
+        return "Dead", person.virus.get_type()
+    if isinstance(state, AsymptomaticSick):
+        return "Asymptomatic", person.virus.get_type()
+    if isinstance(state, SymptomaticSick):
+        return ("Hospitalized" if person.hospitalized else "Symptomatic"), person.virus.get_type()
+    return None, None
+
+
+class CompartmentObservation:
+    '''Compartment transitions of one agent-based run, per InfectableType.'''
+    def __init__(self, n_persons, initial, beds):
+        self.n_persons = n_persons
+        self.initial = initial
+        self.beds = beds
+        self.exposure = {t: 0.0 for t in InfectableType}
+        self.person_days = {}
+        self.transitions = {}
+        self.data = None
+
+
+def observe_agent_run(n_days, seed=0, **params):
+    random.seed(seed)
+    context = initialize(**params)
+    persons = context.persons
+
+    labels = {p.serial: _compartment(p) for p in persons}
+    initial = {t: 0 for t in InfectableType}
+    for compartment, infectable_type in labels.values():
+        if compartment == "Asymptomatic":
+            initial[infectable_type] += 1
+    observation = CompartmentObservation(len(persons), initial, context.health_dept.beds)
+
+    for day in range(n_days):
+        # susceptibility is per type: healthy persons without the antibody
+        asymptomatic = {t: 0 for t in InfectableType}
+        susceptible = {t: 0 for t in InfectableType}
+        for p in persons:
+            compartment, infectable_type = labels[p.serial]
+            if compartment is None:
+                for t in InfectableType:
+                    if t not in p.antibody_types:
+                        susceptible[t] += 1
+            else:
+                key = (compartment, infectable_type)
+                observation.person_days[key] = observation.person_days.get(key, 0) + 1
+                if compartment == "Asymptomatic":
+                    asymptomatic[infectable_type] += 1
+        for t in InfectableType:
+            observation.exposure[t] += susceptible[t] * asymptomatic[t]
+
+        n_archived = len(context.archive)
+        simulate_day(context)
+
+        for p in persons + context.archive[n_archived:]:
+            before, after = labels[p.serial], _compartment(p)
+            if before != after:
+                infectable_type = after[1] if before[0] is None else before[1]
+                key = (before[0], after[0], infectable_type)
+                observation.transitions[key] = observation.transitions.get(key, 0) + 1
+                labels[p.serial] = after
+
+    observation.data = context.health_dept.data.astype(float)
+    return observation
+
+
+class CompartmentalSurrogate:
+    '''Aggregate daily model per InfectableType fitted on agent-based runs.
+
+    Asymptomatic persons move through a chain of `days_to_feel_bad` daily
+    stages, all other transitions are daily rates. Infections are mass action
+    between susceptible and asymptomatic persons on the same canvas.
+    '''
+    RATES = [
+        ("infection", None, "Asymptomatic"),
+        ("hospitalization", "Symptomatic", "Hospitalized"),
+        ("recovery", "Symptomatic", None),
+        ("death", "Symptomatic", "Dead"),
+        ("hospital recovery", "Hospitalized", None),
+        ("hospital death", "Hospitalized", "Dead"),
+    ]
+
+    def __init__(self, rates, days_to_feel_bad, n_persons, initial, beds):
+        self.rates = rates
+        self.days_to_feel_bad = days_to_feel_bad
+        self.n_persons = n_persons
+        self.initial = initial
+        self.beds = beds
+
+    @classmethod
+    def fit(cls, observations):
+        def total(counts, key):
+            return sum(getattr(o, counts).get(key, 0) for o in observations)
+
+        rates = {}
+        asymptomatic_days, feel_bad = 0, 0
+        for t in InfectableType:
+            rates[t] = {}
+            for name, source, target in CompartmentalSurrogate.RATES:
+                count = total("transitions", (source, target, t))
+                if source is None:
+                    exposure = sum(o.exposure[t] for o in observations)
+                else:
+                    exposure = total("person_days", (source, t))
+                rates[t][name] = count / exposure if exposure else 0.0
+
+            asymptomatic_days += total("person_days", ("Asymptomatic", t))
+            feel_bad += total("transitions", ("Asymptomatic", "Symptomatic", t)) + \
+                total("transitions", ("Asymptomatic", "Hospitalized", t))
+
+        days_to_feel_bad = max(1, int(round(asymptomatic_days / feel_bad))) if feel_bad else AsymptomaticSick.DAYS_SICK_TO_FEEL_BAD
+        n_persons = sum(o.n_persons for o in observations) / len(observations)
+        initial = {t: sum(o.initial[t] for o in observations) / len(observations) for t in InfectableType}
+        beds = sum(o.beds for o in observations) / len(observations)
+        return cls(rates, days_to_feel_bad, n_persons, initial, beds)
+
+    def rate_table(self):
+        return pd.DataFrame({t.name: rates for t, rates in self.rates.items()}).T
+
+    def simulate(self, n_days, n_persons=None, initial=None, beds=None):
+        n_persons = self.n_persons if n_persons is None else n_persons
+        initial = self.initial if initial is None else initial
+        beds = self.beds if beds is None else beds
+        metrics = DailyMetrics()
+        # the seeded cases are reported on the first day
+        new_cases = float(sum(initial.values()))
+
+        chains = {t: [float(initial.get(t, 0))] + [0.0] * (self.days_to_feel_bad - 1) for t in InfectableType}
+        compartments = {t: dict(Symptomatic=0.0, Hospitalized=0.0, Dead=0.0, Recovered=0.0) for t in InfectableType}
+
+        rows = []
+        for day in range(n_days):
+            sick = sum(sum(chains[t]) + c["Symptomatic"] + c["Hospitalized"] + c["Dead"] for t, c in compartments.items())
+            healthy = max(0.0, n_persons - sick)
+
+            for t, c in compartments.items():
+                rates = self.rates[t]
+
+                # hospitals treat, the sick get worse or die during the day
+                from_hospital = min(c["Hospitalized"], (rates["hospital recovery"] + rates["hospital death"]) * c["Hospitalized"])
+                hospital_share = rates["hospital recovery"] / (rates["hospital recovery"] + rates["hospital death"]) if from_hospital else 0.0
+                from_symptomatic = min(c["Symptomatic"], (rates["hospitalization"] + rates["recovery"] + rates["death"]) * c["Symptomatic"])
+                symptomatic_total = rates["hospitalization"] + rates["recovery"] + rates["death"]
+
+                discharged = from_hospital * hospital_share
+                c["Hospitalized"] -= from_hospital
+                c["Dead"] += from_hospital - discharged
+                c["Recovered"] += discharged
+
+                if from_symptomatic:
+                    c["Symptomatic"] -= from_symptomatic
+                    c["Hospitalized"] += from_symptomatic * rates["hospitalization"] / symptomatic_total
+                    c["Dead"] += from_symptomatic * rates["death"] / symptomatic_total
+                    c["Recovered"] += from_symptomatic * rates["recovery"] / symptomatic_total
+
+                # contacts, then the night moves the asymptomatic one stage on
+                susceptible = max(0.0, healthy - c["Recovered"])
+                infections = min(susceptible, rates["infection"] * susceptible * sum(chains[t]))
+                chain = chains[t]
+                c["Symptomatic"] += chain[-1]
+                chains[t] = [infections] + chain[:-1]
+                new_cases += infections
+
+            counters = [
+                sum(sum(chains[t]) + c["Symptomatic"] + c["Hospitalized"] for t, c in compartments.items()),
+                sum(c["Hospitalized"] for c in compartments.values()),
+                sum(c["Dead"] for c in compartments.values()),
+                sum(c["Recovered"] for c in compartments.values()),
+                min(n_persons, sum(c["Recovered"] for c in compartments.values())),
+            ]
+            rows.append(counters + metrics.add_day(counters, new_cases, n_persons, beds))
+            new_cases = 0.0
+
+        return pd.DataFrame(rows, columns=DepartmentOfHealth.COLUMNS + DepartmentOfHealth.METRICS)
+
+    def error_report(self, observations):
+        '''Errors of the surrogate against the mean table of held-out agent runs.'''
+        n_days = min(len(o.data) for o in observations)
+        expected = sum(o.data.iloc[:n_days] for o in observations) / len(observations)
+        n_persons = sum(o.n_persons for o in observations) / len(observations)
+        initial = {t: sum(o.initial[t] for o in observations) / len(observations) for t in InfectableType}
+        beds = sum(o.beds for o in observations) / len(observations)
+        # days without growth have an infinite doubling time, they are left out
+        simulated = self.simulate(n_days, n_persons, initial, beds).replace([math.inf, -math.inf], math.nan)
+        expected = expected.replace([math.inf, -math.inf], math.nan)
+        error = simulated - expected
+
+        return pd.DataFrame({
+            "MAE": error.abs().mean(),
+            "RMSE": (error ** 2).mean() ** 0.5,
+            "Max error": error.abs().max(),
+            "Relative MAE": error.abs().mean() / expected.abs().mean().replace(0, float("nan")),
+        })
+
+
+def calibrate_surrogate(n_runs=3, n_days=60, seed=0, **params):
+    observations = [observe_agent_run(n_days, seed + r, **params) for r in range(n_runs)]
+    return CompartmentalSurrogate.fit(observations)
+
+
 class Drug(ABC):
     def apply(self, person):
         # somehow reduce person's symptoms
@@ -639,6 +1731,10 @@ class State(ABC):
     @abstractmethod
     def get_infected(self, virus): pass
 
+    def schedule(self): pass
+
+    def on_timer(self): pass
+
 
 class Healthy(State):
 
@@ -662,18 +1758,32 @@ class AsymptomaticSick(State):
     
     def __init__(self, person):
         super().__init__(person)
-        self.days_sick = 0
         person.infected = True
+        person.new_case = True
+        # persons outside of a simulation count their nights themselves
+        wheel = person.timer_wheel
+        self.tonight = wheel.now if wheel is not None else 0
+        self.feel_bad_day = self.tonight + AsymptomaticSick.DAYS_SICK_TO_FEEL_BAD
+        self.schedule()
+
+    def schedule(self):
+        if self.person.timer_wheel is not None:
+            self.person.timer_wheel.schedule(self.feel_bad_day, self)
+
+    def on_timer(self):
+        self.person.position = self.person.home_position
+        self.person.set_state(SymptomaticSick(self.person))
 
     def day_actions(self):
         # different for CommunityPerson?!
         self.person.position = (randint(self.person.min_j, self.person.max_j), randint(self.person.min_i, self.person.max_i))
 
     def night_actions(self):
+        # a night spent outside of simulate_day, due on the same day as on the wheel
         self.person.position = self.person.home_position
-        self.days_sick += 1
-        if self.days_sick == AsymptomaticSick.DAYS_SICK_TO_FEEL_BAD:
-            self.person.set_state(SymptomaticSick(self.person))
+        self.tonight += 1
+        if self.tonight >= self.feel_bad_day:
+            self.on_timer()
 
     def interact(self, other):
         other.get_infected(self.person.virus)
@@ -682,6 +1792,21 @@ class AsymptomaticSick(State):
 
 
 class SymptomaticSick(State):
+    def __init__(self, person):
+        super().__init__(person)
+        self.schedule()
+
+    def schedule(self):
+        # the virus is fought every night
+        wheel = self.person.timer_wheel
+        if wheel is not None:
+            wheel.schedule(wheel.now + 1, self)
+
+    def on_timer(self):
+        self.night_actions()
+        if self.person.state is self:
+            self.schedule()
+
     def day_actions(self):
         self.person.progress_disease()
         
@@ -733,7 +1858,7 @@ def main():
     for day in tqdm.tqdm(range(100)):
         simulate_day(context)
 
-    context.health_dept.data.plot()
+    context.health_dept.data[DepartmentOfHealth.COLUMNS].plot()
     print(context.health_dept.data)
     plt.show()
 
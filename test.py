@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 
 import covid_simulation as cs
+import numpy as np
+import gc
+import math
+import os
+import tempfile
 import unittest
 from random import randint
 
@@ -173,6 +178,355 @@ class ChangeStateToDeadTestCase(unittest.TestCase):
 
 
 
+# Regions of a metapopulation are simulated in parallel and exchange travellers,
+# the total population is preserved and the aggregated table sums the regions.
+class MetapopulationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.n_persons = [100, 150, 120]
+        self.metapopulation = cs.Metapopulation([dict(n_persons=n) for n in self.n_persons], travel_fraction=0.1, seed=7)
+
+    def tearDown(self):
+        self.metapopulation.close()
+
+    def test(self):
+        data = self.metapopulation.run(3)
+
+        self.assertEqual(len(data), 3)
+        self.assertEqual(sum(self.metapopulation.population), sum(self.n_persons))
+        self.assertEqual(data["New cases"].cumsum().tolist(), data["Cumulative infections"].tolist())
+        self.assertNotEqual(self.metapopulation.population, self.n_persons)
+
+        regions = self.metapopulation.region_data
+        self.assertEqual(len(regions), 3)
+        self.assertEqual(data["Infected"].tolist(), [sum(x) for x in zip(*[r["Infected"] for r in regions])])
+
+    def test_dead_region(self):
+        # closing after the failure of a region does not raise and hide it
+        metapopulation = cs.Metapopulation([dict(n_persons=50), dict(n_persons=50, unknown=1)], seed=1)
+        with self.assertRaises((EOFError, OSError)):
+            metapopulation.run(1)
+        metapopulation.close()
+        self.assertEqual(metapopulation.workers, [])
+
+
+
+# The memory report breaks the footprint down by subsystem and enforces a budget.
+class MemoryReportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = cs.initialize(n_persons=200)
+        cs.simulate_day(self.context)
+
+    def tearDown(self):
+        del self.context
+
+    def test_report(self):
+        report = cs.memory_report(self.context, sample_size=50)
+
+        self.assertEqual(report.n_agents, 200)
+        self.assertGreater(report.sizes["DefaultPerson"], 0)
+        self.assertIn("DepartmentOfHealth.data", report.sizes)
+        self.assertGreater(report.bytes_per_agent, 0)
+        self.assertGreater(report.projected_bytes(2000), report.projected_bytes(200))
+
+    def test_budget(self):
+        report = cs.memory_report(self.context)
+        with self.assertRaises(MemoryError):
+            report.check_budget(1000, n_agents=10 ** 6)
+        with self.assertRaises(MemoryError):
+            cs.initialize(n_persons=10 ** 6, memory_budget=10 ** 6)
+
+
+
+# A seeded trace replays identically with the reference engine and the
+# first divergence of another execution path is reported.
+class GoldenTraceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.trace = cs.record_trace(10, seed=1, n_persons=400)
+
+    def tearDown(self):
+        del self.trace
+
+    def test_replay(self):
+        self.assertEqual(len(self.trace.days), 10)
+        kinds = set(event[0] for positions, events in self.trace.days for event in events)
+        self.assertTrue({"contact", "infect", "state", "admit", "drug"} <= kinds)
+        self.assertIsNone(cs.replay_trace(self.trace))
+
+    def test_divergence(self):
+        def shuffled_day(context, recorder):
+            if len(context.health_dept.data) == 3:
+                context.persons.reverse()
+            cs.simulate_day(context, recorder)
+
+        divergence = cs.replay_trace(self.trace, shuffled_day)
+        self.assertIsNotNone(divergence)
+        self.assertEqual(divergence.day, 3)
+
+
+
+# Disease progression is driven by the timer wheel: an infection schedules
+# its transition and only due states are touched at night.
+class TimerWheelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = cs.initialize(n_persons=100)
+
+    def tearDown(self):
+        del self.context
+
+    def test(self):
+        wheel = self.context.timer_wheel
+        sick = [p for p in self.context.persons if isinstance(p.state, cs.AsymptomaticSick)]
+        self.assertEqual(len(wheel.slots[cs.AsymptomaticSick.DAYS_SICK_TO_FEEL_BAD]), len(sick))
+
+        cs.simulate_day(self.context)
+        self.assertTrue(all(isinstance(p.state, cs.AsymptomaticSick) for p in sick))
+
+        cs.simulate_day(self.context)
+        for p in sick:
+            self.assertNotIsInstance(p.state, cs.AsymptomaticSick)
+        self.assertTrue(all(day > wheel.now for day in wheel.slots))
+
+    def test_outside_persons(self):
+        # throwaway populations and hand-built states stay off the wheel of the context
+        context = cs.initialize(n_persons=100, memory_budget=10 ** 9)
+        wheel = context.timer_wheel
+        self.assertEqual(len(wheel.slots[cs.AsymptomaticSick.DAYS_SICK_TO_FEEL_BAD]), 80)
+
+        person = generator_randomized_persons(1, infect_flag=True)[0]
+        person.set_state(cs.SymptomaticSick(person))
+        self.assertEqual(sum(len(states) for states in wheel.slots.values()), 80)
+
+
+
+# A sweep stops poor configurations early and ranks the survivors first.
+class SweepTestCase(unittest.TestCase):
+    def setUp(self):
+        self.configurations = [
+            dict(n_persons=200, n_cholera=n_cholera, n_sars=0, drug_repository=cs.ExpensiveDrugRepository)
+            for n_cholera in (80, 10, 40, 20)
+        ]
+
+    def tearDown(self):
+        del self.configurations
+
+    def test(self):
+        summary = cs.sweep(self.configurations, n_days=12, replicates=2, metric="Infected", eta=2, min_days=3)
+
+        self.assertEqual(len(summary), 4)
+        self.assertEqual(summary["Days"].iloc[0], 12)
+        self.assertEqual(summary["n_cholera"].iloc[0], 10)
+        self.assertEqual(summary["n_cholera"].iloc[-1], 80)
+        self.assertLess(summary["Days"].iloc[-1], 12)
+        finished = summary[summary["Days"] == 12]
+        self.assertEqual(finished["Mean"].tolist(), sorted(finished["Mean"]))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            cs.sweep(self.configurations, n_days=5, eta=1)
+        with self.assertRaises(ValueError):
+            cs.sweep(self.configurations, n_days=5, min_days=0)
+
+
+
+# A population written to a columnar file loads back into the same persons.
+class PopulationFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "population.bin")
+        self.persons = generator_randomized_persons(50, infect_flag=True)
+        self.persons[-1].antibody_types.add(cs.InfectableType.Cholera)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        del self.persons
+
+    def test(self):
+        cs.save_population(self.persons, self.path)
+        canvas, columns = cs.read_population(self.path)
+        self.assertEqual(canvas, (0, 100, 0, 100))
+        self.assertEqual(columns["age"].tolist(), [p.age for p in self.persons])
+
+        loaded = cs.load_population(self.path)
+        self.assertEqual(len(loaded), len(self.persons))
+        for original, person in zip(self.persons, loaded):
+            self.assertIs(type(person), type(original))
+            self.assertEqual(person.home_position, original.home_position)
+            self.assertEqual((person.age, person.weight), (original.age, original.weight))
+            self.assertEqual(person.antibody_types, original.antibody_types)
+            self.assertEqual(type(person.state), type(original.state))
+            if original.virus is not None:
+                self.assertEqual(person.virus.get_type(), original.virus.get_type())
+                self.assertAlmostEqual(person.virus.strength, original.virus.strength)
+
+        context = cs.initialize(population_file=self.path)
+        self.assertEqual(len(context.persons), 50)
+        with self.assertRaises(ValueError):
+            cs.initialize(population_file=self.path, n_cholera=10)
+
+    def test_broken_file(self):
+        cs.save_population(self.persons, self.path)
+        canvas, columns = cs.read_population(self.path)
+        virus = np.memmap(self.path, dtype=columns["virus"].dtype, mode="r+",
+                          offset=columns["virus"].offset, shape=columns["virus"].shape)
+        virus[0] = 99
+        virus.flush()
+        del virus, columns
+
+        with self.assertRaises(KeyError):
+            cs.load_population(self.path)
+        self.assertTrue(gc.isenabled())
+
+
+
+# Cell occupancy covers every person each day and infections are counted
+# in the cell where they happened.
+class CellOccupancyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = cs.initialize(n_persons=400)
+        self.context.occupancy = cs.CellOccupancy(self.context.canvas, coarsen=10)
+
+    def tearDown(self):
+        del self.context
+
+    def test(self):
+        new_infections = []
+        for _ in range(6):
+            healthy = [p for p in self.context.persons if isinstance(p.state, cs.Healthy)]
+            cs.simulate_day(self.context)
+            new_infections.append(sum(isinstance(p.state, cs.AsymptomaticSick) for p in healthy))
+
+        occupancy = self.context.occupancy
+        self.assertEqual(occupancy.occupancy.shape, (6, 11 * 11))
+        self.assertEqual(occupancy.occupancy.sum(axis=1).tolist(), [400] * 6)
+        self.assertEqual(occupancy.infections_per_cell.sum(axis=1).tolist(), new_infections)
+        self.assertEqual(occupancy.grid().shape, (11, 11))
+        self.assertEqual(len(occupancy.hotspots(3)), 3)
+
+
+
+# The compartmental surrogate is fitted on agent runs and produces the
+# statistics table of the department of health.
+class CompartmentalSurrogateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.observations = [cs.observe_agent_run(20, seed, n_persons=300) for seed in range(3)]
+
+    def tearDown(self):
+        del self.observations
+
+    def test(self):
+        surrogate = cs.CompartmentalSurrogate.fit(self.observations[:2])
+        self.assertEqual(surrogate.days_to_feel_bad, cs.AsymptomaticSick.DAYS_SICK_TO_FEEL_BAD)
+        self.assertGreater(surrogate.rates[cs.InfectableType.Cholera]["infection"], 0)
+
+        data = surrogate.simulate(30)
+        self.assertEqual(list(data.columns), cs.DepartmentOfHealth.COLUMNS + cs.DepartmentOfHealth.METRICS)
+        self.assertEqual(len(data), 30)
+        self.assertTrue((data["Deaths"].diff().dropna() >= 0).all())
+
+        report = surrogate.error_report(self.observations[2:])
+        self.assertEqual(list(report.index), cs.DepartmentOfHealth.COLUMNS + cs.DepartmentOfHealth.METRICS)
+        report = report.dropna()
+        self.assertTrue((report["RMSE"] >= report["MAE"] - 1e-9).all())
+
+
+
+# Scenarios forked from a shared prefix start from the same state and only
+# differ by their intervention.
+class BranchScenariosTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = cs.initialize(n_persons=300)
+        for _ in range(5):
+            cs.simulate_day(self.context)
+
+    def tearDown(self):
+        del self.context
+
+    def test(self):
+        table = cs.branch_scenarios(self.context, {
+            "baseline": None,
+            "expensive drugs": cs.switch_drug_repository(cs.ExpensiveDrugRepository),
+            "more hospitals": cs.add_hospitals(2),
+        }, n_days=5)
+
+        self.assertEqual(list(table.index.get_level_values("Scenario").unique()), ["baseline", "expensive drugs", "more hospitals"])
+        for scenario in ("baseline", "expensive drugs", "more hospitals"):
+            branch = table.loc[scenario]
+            self.assertEqual(len(branch), 10)
+            self.assertTrue(branch.iloc[:5].equals(table.loc["baseline"].iloc[:5]))
+
+        # the prefix itself is untouched
+        self.assertEqual(len(self.context.health_dept.data), 5)
+        self.assertEqual(len(self.context.health_dept.hospitals), 4)
+
+    def test_failure(self):
+        def broken(context):
+            raise ValueError()
+
+        with self.assertRaises(RuntimeError):
+            cs.branch_scenarios(self.context, {"broken": broken}, n_days=1)
+
+    def test_killed(self):
+        def killed(context):
+            os._exit(1)
+
+        with self.assertRaises(RuntimeError):
+            cs.branch_scenarios(self.context, {"killed": killed, "baseline": None}, n_days=1)
+
+
+
+# Dead persons are moved out of the population into the archive and are
+# still counted by the department of health.
+class CompactionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = cs.initialize(n_persons=200)
+        self.context.compaction_interval = 2
+        for person in self.context.persons[:10]:
+            person.set_state(cs.Dead(person))
+
+    def tearDown(self):
+        del self.context
+
+    def test(self):
+        for day in range(6):
+            cs.simulate_day(self.context)
+            everyone = self.context.persons + self.context.archive
+            last = self.context.health_dept.data.iloc[-1]
+            self.assertEqual(last["Deaths"], sum(p.dead for p in everyone))
+            self.assertEqual(last["Recoveries"], sum(p.recovered for p in everyone))
+
+        self.assertEqual(len(self.context.persons) + len(self.context.archive), 200)
+        self.assertGreaterEqual(len(self.context.archive), 10)
+        self.assertFalse(any(p.dead for p in self.context.persons))
+
+
+
+# The department keeps cumulative and rate metrics next to its daily counters.
+class DailyMetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = cs.initialize(n_persons=300)
+
+    def tearDown(self):
+        del self.context
+
+    def test(self):
+        for _ in range(8):
+            cs.simulate_day(self.context)
+
+        data = self.context.health_dept.data
+        self.assertEqual(list(data.columns), cs.DepartmentOfHealth.COLUMNS + cs.DepartmentOfHealth.METRICS)
+        self.assertGreaterEqual(data["New cases"].iloc[0], 80)
+        self.assertEqual(data["New cases"].cumsum().tolist(), data["Cumulative infections"].tolist())
+        self.assertAlmostEqual(data["Incidence per 100k"].iloc[0], data["New cases"].iloc[0] / 300 * 100000)
+        self.assertEqual(data["Hospital occupancy"].tolist(), (data["Hospitalized"] / 400).tolist())
+        self.assertEqual(self.context.health_dept.today["Cumulative infections"], data["Cumulative infections"].iloc[-1])
+
+        growing = data[data["Cumulative infections"].diff() > 0]
+        for day, row in growing.iterrows():
+            previous = data["Cumulative infections"].iloc[day - 1]
+            self.assertAlmostEqual(row["Doubling time"], math.log(2) / math.log(row["Cumulative infections"] / previous))
+
+
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file